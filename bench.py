@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Measures DATA_ADD ingest throughput of a storage node against the number of worker processes serving it.
+
+from common import *    # RequestType, Fields, RequestTypeIndex
+from node import Node
+from storagenode import StorageNode
+from multiprocessnode import MultiProcessStorageNode
+import os
+import sys
+import time
+import socket
+import shutil
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+def sendDataAdd(host, port, data):
+    """Sends a DATA_ADD request and waits for the stored hash, without a Node of its own."""
+    clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    clientSocket.connect((host, port))
+    buffer = Node.DELIM.join(map(str, (RequestType.DATA_ADD.value, len(data)))) + Node.DELIM
+    clientSocket.sendall(buffer.encode() + data)
+    recvBuffer = b''
+    while Node.DELIM.encode() not in recvBuffer:
+        recvData = clientSocket.recv(4096)
+        if not recvData:
+            raise ConnectionError('connection closed before data add was confirmed')
+        recvBuffer += recvData
+    clientSocket.close()
+
+def client(host, port, chunkSize, chunks, ready, go):
+    """Sends chunks of unique random data once go is set."""
+    logging.disable(logging.INFO)
+    data = bytearray(os.urandom(chunkSize))
+    ready.put(os.getpid())
+    go.wait()
+    for _ in range(chunks):
+        # make every chunk unique so none are deduplicated by hash
+        data[:16] = os.urandom(16)
+        sendDataAdd(host, port, bytes(data))
+
+def run(host, port, workers, clients, chunkSize, chunks):
+    """Ingests clients * chunks chunks of chunkSize bytes into a fresh node.
+
+    Args:
+        workers: number of worker processes, 0 for a single process StorageNode
+
+    Returns:
+        ingest throughput in MiB/s
+    """
+    dataDir = tempfile.mkdtemp(prefix='bench')
+    if workers:
+        node = MultiProcessStorageNode(dataDir, host=host, port=port, workers=workers, logLevel=logging.WARNING)
+    else:
+        node = StorageNode(dataDir, host=host, port=port)
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    go = context.Event()
+    processes = [context.Process(target=client, args=(host, port, chunkSize, chunks, ready, go)) for _ in range(clients)]
+    try:
+        for process in processes:
+            process.start()
+        for _ in processes:
+            ready.get()
+        start = time.monotonic()
+        go.set()
+        for process in processes:
+            process.join()
+        elapsed = time.monotonic() - start
+    finally:
+        node.shutdown()
+        shutil.rmtree(dataDir)
+    if any(process.exitcode for process in processes):
+        raise Exception('a client failed')
+    return clients * chunks * chunkSize / 1048576 / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures ingest throughput against number of worker processes.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8200, help='first port used, each run uses the next one')
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({0, 1, 2, os.cpu_count()}), help='worker counts to measure, 0 is a single process StorageNode')
+    parser.add_argument('--clients', type=int, default=2 * os.cpu_count(), help='concurrent client processes')
+    parser.add_argument('--chunk-mib', type=int, default=4, help='size of each DATA_ADD')
+    parser.add_argument('--total-mib', type=int, default=1024, help='data sent per run')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    chunkSize = args.chunk_mib * 1048576
+    chunks = max(1, args.total_mib // args.chunk_mib // args.clients)
+    print('%s cores, %s clients, %s x %s MiB per client' % (os.cpu_count(), args.clients, chunks, args.chunk_mib))
+    print('%8s %10s %8s' % ('workers', 'MiB/s', 'scaling'))
+    baseline = None
+    for i, workers in enumerate(args.workers):
+        throughput = run(args.host, args.port + i, workers, args.clients, chunkSize, chunks)
+        baseline = baseline or throughput
+        print('%8s %10.1f %7.2fx' % (workers, throughput, throughput / baseline))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,9 @@ RequestType = Enum('RequestType', [
     'DISCONNECT',   # request to remove one another from peers list
     'GET_PEERS',    # request remote host's peers list
     'DATA_ADD',     # request remote host to add provided data to its storage directory
-    'DATA_GET',     # request data with the provided hash
+    'DATA_GET',     # request data with the provided hash, sent at the provided scheduler priority
     'DATA_REMOVE',  # request remote host to remove data with the provided hash from its storage directory
+    'DATA_GET_RANGE',   # request LENGTH bytes starting at OFFSET of data with the provided hash, sent at the provided priority
 ])
 
 # field indices by message type (seperated by a delim)
@@ -20,8 +21,9 @@ Fields = {
         RequestType.DISCONNECT  : Enum('DisconnectFields',  ['TYPE', 'HOST', 'PORT'],   start=0),
         RequestType.GET_PEERS   : Enum('GetPeersFields',    ['TYPE'],                   start=0),
         RequestType.DATA_ADD    : Enum('DataAddFields',     ['TYPE', 'SIZE', 'DATA'],   start=0),
-        RequestType.DATA_GET    : Enum('DataGetFields',     ['TYPE', 'HASH'],           start=0),
+        RequestType.DATA_GET    : Enum('DataGetFields',     ['TYPE', 'HASH', 'PRIORITY'], start=0),
         RequestType.DATA_REMOVE : Enum('DataRemoveFields',  ['TYPE', 'HASH'],           start=0),
+        RequestType.DATA_GET_RANGE : Enum('DataGetRangeFields', ['TYPE', 'HASH', 'OFFSET', 'LENGTH', 'PRIORITY'], start=0),
 }
 
 RequestTypeIndex = 0
@@ -0,0 +1,74 @@
+# merkle.py
+
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+# size of blocks parts are split into for hashing, leaves of a part's tree
+BLOCK_SIZE = 1048576
+
+# hashlib releases the GIL while hashing large buffers, so blocks are hashed on all cores by threads
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+# maximum blocks of a stream being hashed at once, enough to keep every core busy while more are received
+PENDING_BLOCKS = 2 * os.cpu_count()
+
+def hashBlock(data):
+    """Returns leaf hash of a single block."""
+    leaf = hashlib.sha256(b'\0')
+    leaf.update(data)
+    return leaf.hexdigest()
+
+def submitBlock(data):
+    """Starts hashing a single block on all cores.
+
+    Returns:
+        Future of leaf hash of block
+    """
+    return _executor.submit(hashBlock, data)
+
+def hashBlocks(data):
+    """Returns list of leaf hashes of data split into BLOCK_SIZE blocks, hashed in parallel."""
+    view = memoryview(data)
+    blocks = [view[start:start + BLOCK_SIZE] for start in range(0, len(view), BLOCK_SIZE)]
+    if len(blocks) <= 1:
+        return list(map(hashBlock, blocks))
+    return list(_executor.map(hashBlock, blocks))
+
+def hashPart(data):
+    """Hashes a part for storage and for its tree in parallel.
+
+    Returns:
+        tuple of sha256 hex digest of data and list of its block leaf hashes
+    """
+    digest = _executor.submit(lambda: hashlib.sha256(data).hexdigest())
+    blocks = hashBlocks(data)
+    return digest.result(), blocks
+
+def root(hashes):
+    """Returns root of tree over a list of hashes. An odd node at the end of a level is promoted to the next level.
+
+    Args:
+        hashes: list of hex digests of leaves or subtree roots
+    """
+    if not hashes:
+        return hashlib.sha256(b'').hexdigest()
+    level = [bytes.fromhex(h) for h in hashes]
+    while len(level) > 1:
+        nextLevel = [hashlib.sha256(b'\1' + level[i] + level[i + 1]).digest() for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            nextLevel.append(level[-1])
+        level = nextLevel
+    return level[0].hex()
+
+def fileRoot(blocks):
+    """Returns root of a file's tree, the tree over the roots of each part's blocks.
+
+    Args:
+        blocks: list of block leaf hash lists, one per part
+    """
+    return root([root(partBlocks) for partBlocks in blocks])
+
+def blockCount(size):
+    """Returns number of blocks in data of size bytes."""
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE
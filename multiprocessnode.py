@@ -0,0 +1,279 @@
+# multiprocessnode.py
+
+from common import *    # RequestType, Fields, RequestTypeIndex
+from storagenode import StorageNode
+from scheduler import TransferScheduler
+import os
+import socket
+import logging
+import select
+import signal
+import multiprocessing
+from threading import Thread, Event, Lock
+
+class StorageWorker(StorageNode):
+    """A StorageNode run in a worker process that serves data requests on a port shared with other workers.
+
+    Requests are spread across workers by the kernel (SO_REUSEPORT). Data requests are handled by the worker against
+    the shared _dataDir, membership requests are relayed to the parent MultiProcessStorageNode which owns the peers list.
+
+    _controlAddress:    address of parent's socket membership requests are relayed to
+    """
+
+    def __init__(self, dataDir, host, port, controlAddress):
+        """Creates a worker accepting on a shared port.
+
+        Args:
+            dataDir: see super()
+            host: see super()
+            port: port shared by all workers
+            controlAddress: _controlAddress
+        """
+        self._controlAddress = controlAddress
+        super().__init__(dataDir, host, port)
+        for requestType in (RequestType.CONNECT, RequestType.DISCONNECT, RequestType.GET_PEERS):
+            self._handlers[requestType] = self._relay
+            self._threadedHandlers.add(requestType)
+
+    def shutdown(self):
+        """Terminates thread and closes socket. Worker cannot be restarted after this is called."""
+        self._logger.info('shutting down worker')
+        if not self._handleIncomingContinue:
+            self._logger.info('already shutdown, nothing to do')
+            return
+        self._handleIncomingContinue = False
+        # a ping to the shared port may be accepted by another worker, so unblock accept() by shutting down the socket
+        self._serverSocket.shutdown(socket.SHUT_RDWR)
+        self._serverThread.join()
+        self._serverSocket.close()
+        self._logger.info('shutdown complete')
+
+    def handleIncoming(self):
+        """A loop to continuously call incoming connection handler until worker is shut down."""
+        while self._handleIncomingContinue:
+            try:
+                self._handleIncoming()
+            except OSError:
+                if self._handleIncomingContinue:
+                    raise
+
+    def _bindServerSocket(self, host, port):
+        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        serverSocket.bind((host, port))
+        serverSocket.listen(128)
+        return serverSocket
+
+    def _relay(self, buffer, connection):
+        """Relays a request to the parent node and its response back until the parent closes the connection.
+
+        Args:
+            buffer: socket buffer
+            connection: incoming connection socket
+        """
+        parentSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        parentSocket.connect(self._controlAddress)
+        parentSocket.sendall(buffer)
+        other = {connection: parentSocket, parentSocket: connection}
+        try:
+            while True:
+                readable, _, _ = select.select(list(other), [], [])
+                for readSocket in readable:
+                    data = readSocket.recv(4096)
+                    if data:
+                        other[readSocket].sendall(data)
+                    elif readSocket is parentSocket:
+                        # parent handled request
+                        return
+                    else:
+                        # requester is done sending, keep relaying the response
+                        del other[connection]
+        finally:
+            parentSocket.close()
+
+class MultiProcessScheduler(TransferScheduler):
+    """Scheduler of a MultiProcessStorageNode. Rate changes are also sent to the schedulers of its workers.
+
+    Workers serve the node's data requests between them, so each is given an equal share of every rate.
+
+    _node:  MultiProcessStorageNode whose workers are sent rate changes
+    """
+
+    def __init__(self, node):
+        super().__init__()
+        self._node = node
+
+    def setGlobalRate(self, rate):
+        super().setGlobalRate(rate)
+        self._node._sendRateChange(('setGlobalRate', rate))
+
+    def setPeerRate(self, host, rate):
+        super().setPeerRate(host, rate)
+        self._node._sendRateChange(('setPeerRate', host, rate))
+
+    def setDefaultPeerRate(self, rate):
+        super().setDefaultPeerRate(rate)
+        self._node._sendRateChange(('setDefaultPeerRate', rate))
+
+    def rateChanges(self):
+        """Returns list of rate changes that configure a new scheduler with the rates of this one."""
+        with self._cond:
+            changes = [('setGlobalRate', self._globalBucket.rate), ('setDefaultPeerRate', self._defaultPeerRate)]
+            return changes + [('setPeerRate', host, rate) for host, rate in self._peerRates.items()]
+
+class MultiProcessStorageNode(StorageNode):
+    """A StorageNode whose data requests are served by several worker processes to use more than one core.
+
+    Workers accept on the node's port with SO_REUSEPORT and share _dataDir. This process owns the peers list, handles
+    membership requests relayed by workers on a private socket, and restarts workers that exit. Client operations
+    (uploadFile, downloadFile, ...) run in this process as usual. Rates set on the node's MultiProcessScheduler limit
+    this process's transfers and are split evenly between the workers for the requests they serve.
+
+    Workers are started with the spawn method, so scripts creating this node must guard their entry point with
+    `if __name__ == '__main__'`.
+
+    _workerCount:       number of worker processes
+    _logLevel:          level below which workers drop log messages
+    _workers:           list of worker processes
+    _rateConnections:   map of worker process to connection its rate changes are sent on
+    _workersMutex:      mutex for _workers and _rateConnections, so a starting worker does not miss a rate change
+    _context:           multiprocessing context workers are started from
+    _stopWorkers:       Event set to stop supervising workers
+    _supervisorThread:  thread restarting workers that exit
+    """
+
+    def __init__(self, dataDir, host=socket.gethostbyname(socket.gethostname()), port=8089, workers=os.cpu_count(), logLevel=logging.DEBUG):
+        """Creates node and starts its workers.
+
+        Args:
+            dataDir: see super()
+            host: see super()
+            port: port workers accept on
+            workers: _workerCount, default is number of cores
+            logLevel: _logLevel, default is logging.DEBUG
+        """
+        super().__init__(dataDir, host, port)
+        self._workerCount = workers
+        self._logLevel = logLevel
+        self._scheduler = MultiProcessScheduler(self)
+        self._context = multiprocessing.get_context('spawn')
+        self._rateConnections = dict()
+        self._workersMutex = Lock()
+        self._stopWorkers = Event()
+        self._workers = [self._startWorker() for _ in range(workers)]
+        self._supervisorThread = Thread(target=self._superviseWorkers)
+        self._supervisorThread.start()
+        self._logger.info('started %s workers' % workers)
+
+    def shutdown(self):
+        """Stops workers, then shuts down node. Node cannot be restarted after this is called."""
+        if self._handleIncomingContinue:
+            self._logger.info('stopping workers')
+            self._stopWorkers.set()
+            self._supervisorThread.join()
+            for worker in self._workers:
+                # workers shut down gracefully on SIGTERM
+                worker.terminate()
+            for worker in self._workers:
+                worker.join(10)
+                if worker.is_alive():
+                    self._logger.info('killing worker %s' % worker.pid)
+                    worker.kill()
+                with self._workersMutex:
+                    self._rateConnections.pop(worker).close()
+        super().shutdown()
+
+    def _bindServerSocket(self, host, port):
+        # workers accept on port, this socket only receives membership requests they relay
+        return super()._bindServerSocket(host, 0)
+
+    def _startWorker(self):
+        """Starts a worker process and waits for it to accept on the node's port.
+
+        Returns:
+            worker process
+
+        Raises:
+            Exception: if worker does not start
+        """
+        ready = self._context.Event()
+        rateConnection, workerRateConnection = self._context.Pipe()
+        rateChanges = [self._workerShare(change) for change in self._scheduler.rateChanges()]
+        worker = self._context.Process(target=_runWorker, args=(self._dataDir, *self.thisPeer, self._serverSocket.getsockname(), ready, os.getpid(), self._logLevel, workerRateConnection, rateChanges), daemon=True)
+        worker.start()
+        workerRateConnection.close()
+        if not ready.wait(30):
+            worker.terminate()
+            rateConnection.close()
+            raise Exception('worker %s failed to start' % worker.pid)
+        self._rateConnections[worker] = rateConnection
+        self._logger.info('started worker %s' % worker.pid)
+        return worker
+
+    def _superviseWorkers(self):
+        """Restarts workers that exit until workers are stopped."""
+        while not self._stopWorkers.wait(1):
+            for i, worker in enumerate(self._workers):
+                if not worker.is_alive() and not self._stopWorkers.is_set():
+                    self._logger.info('worker %s exited with %s, restarting' % (worker.pid, worker.exitcode))
+                    with self._workersMutex:
+                        try:
+                            self._workers[i] = self._startWorker()
+                        except Exception as e:
+                            # keep supervising, the exited worker is restarted on a later tick
+                            self._logger.info('failed to restart worker: %s' % e)
+                            continue
+                        self._rateConnections.pop(worker).close()
+
+    def _sendRateChange(self, change):
+        """Sends each worker its share of a rate change.
+
+        Args:
+            change: tuple of MultiProcessScheduler method name and arguments, rate last
+        """
+        with self._workersMutex:
+            for worker, rateConnection in self._rateConnections.items():
+                try:
+                    rateConnection.send(self._workerShare(change))
+                except OSError as e:
+                    # worker exited, it is restarted with current rates
+                    self._logger.info('failed to send rates to worker %s: %s' % (worker.pid, e))
+
+    def _workerShare(self, change):
+        """Returns a rate change with its rate divided between workers. Unlimited (None) stays unlimited."""
+        name, *args, rate = change
+        return (name, *args, rate / self._workerCount if rate else rate)
+
+    @property
+    def workers(self):
+        return list(self._workers)
+
+def _runWorker(dataDir, host, port, controlAddress, ready, parentPid, logLevel, rateConnection, rateChanges):
+    """Entry point of a worker process. Serves until terminated or parent exits."""
+    # logging configuration is not inherited by spawned processes, Node configures it to log everything
+    logging.disable(logLevel - 1)
+    stop = Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    worker = StorageWorker(dataDir, host, port, controlAddress)
+    for change in rateChanges:
+        _applyRateChange(worker.scheduler, change)
+    Thread(target=_receiveRateChanges, args=(worker.scheduler, rateConnection), daemon=True).start()
+    ready.set()
+    while not stop.wait(1):
+        if os.getppid() != parentPid:
+            # parent died without stopping workers
+            break
+    worker.shutdown()
+
+def _receiveRateChanges(scheduler, rateConnection):
+    """Applies rate changes sent by the parent until it closes the connection."""
+    while True:
+        try:
+            change = rateConnection.recv()
+        except (EOFError, OSError):
+            return
+        _applyRateChange(scheduler, change)
+
+def _applyRateChange(scheduler, change):
+    name, *args = change
+    getattr(scheduler, name)(*args)
@@ -22,6 +22,7 @@ class Node:
     _serverThread:  thread on which self._serverSocket listens
     _handleIncomingConnections: flag used to terminate self._serverThread on shutdown
     _handlers:      map of message type to corresponding message handling function
+    _threadedHandlers:  set of message types whose handlers run on their own thread so that long transfers do not block other requests
     """
 
     DELIM = '\1'
@@ -41,10 +42,8 @@ class Node:
         self._thisPeer = (host, port)
         self._peers = set()
 
-        self._serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._serverSocket.bind((host, port))
-        self._serverSocket.listen(3)
-        self._logger = logging.getLogger('%s' % str(self._serverSocket.getsockname()))
+        self._serverSocket = self._bindServerSocket(host, port)
+        self._logger = logging.getLogger('%s' % str(self._thisPeer))
         self._logger.info('initialized socket')
 
         # start server thread
@@ -58,6 +57,7 @@ class Node:
             RequestType.DISCONNECT : self._handleDisconnect,
             RequestType.GET_PEERS  : self._handleGetPeers,
         }
+        self._threadedHandlers = set()
 
     def __del__(self):
         self.shutdown()
@@ -71,13 +71,28 @@ class Node:
         self._handleIncomingContinue = False
         sleep(1)
         try:
-            self.sendPing(*self.thisPeer)  # a hack to move the loop forward in case no other nodes are connecting
+            self.sendPing(*self._serverSocket.getsockname())  # a hack to move the loop forward in case no other nodes are connecting
         except:
             pass
         self._serverThread.join()
         self._serverSocket.close()
         self._logger.info('shutdown complete')
 
+    def _bindServerSocket(self, host, port):
+        """Creates the socket incoming connections are accepted on.
+
+        Args:
+            host: address to bind to
+            port: port to bind to
+
+        Returns:
+            listening socket
+        """
+        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serverSocket.bind((host, port))
+        serverSocket.listen(3)
+        return serverSocket
+
     def joinNetwork(self, host, port):
         """Joins the peer-to-peer network through a single Node.
 
@@ -141,7 +156,7 @@ class Node:
         if ((host, port) == self.thisPeer):
             raise Exception('attempted to contact self host')
         self._logger.info('connecting to %s:%s' % (host, port))
-        buffer = Node.DELIM.join(map(str, (RequestType.CONNECT.value, *self._serverSocket.getsockname()))) + Node.DELIM
+        buffer = Node.DELIM.join(map(str, (RequestType.CONNECT.value, *self.thisPeer))) + Node.DELIM
         self._logger.debug('sending buffer: %s' % buffer)
         clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         clientSocket.connect((host, port))
@@ -163,7 +178,7 @@ class Node:
         if ((host, port) == self.thisPeer):
             raise Exception('attempted to contact self host')
         self._logger.info('disconnecting from %s:%s' % (host, port))
-        buffer = Node.DELIM.join(map(str, (RequestType.DISCONNECT.value, *self._serverSocket.getsockname()))) + Node.DELIM
+        buffer = Node.DELIM.join(map(str, (RequestType.DISCONNECT.value, *self.thisPeer))) + Node.DELIM
         self._logger.debug('sending buffer: %s' % buffer)
         clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         clientSocket.connect((host, port))
@@ -212,18 +227,29 @@ class Node:
 
     def _handleIncoming(self):
         """Waits for and handles incoming messages.
-        Calls appropriate handler based on message type on separate thread.
+        Calls appropriate handler based on message type, on a separate thread if its type is in _threadedHandlers.
         """
         connection, address = self._serverSocket.accept()
         self._logger.info('accepted %s' % str(address))
-        # TODO create thread per connection
         buffer = connection.recv(4096)
         self._logger.info('received buffer')
         headbuffer = buffer[:len(str(len(RequestType))) + 1].decode()   # to decode only portion needed for determining message type
         incomingRequestType = RequestType(int(headbuffer.split(Node.DELIM)[RequestTypeIndex]))
         self._logger.info('received incoming request %s' % incomingRequestType)
-        self.handlers[incomingRequestType](buffer, connection)
-        connection.close()
+        if incomingRequestType in self._threadedHandlers:
+            Thread(target=self._handleRequest, args=(incomingRequestType, buffer, connection)).start()
+        else:
+            self._handleRequest(incomingRequestType, buffer, connection)
+
+    def _handleRequest(self, requestType, buffer, connection):
+        """Calls handler for a request and closes its connection."""
+        try:
+            self.handlers[requestType](buffer, connection)
+        except (BrokenPipeError, ConnectionResetError):
+            # e.g. requester stopped reading data that failed verification
+            self._logger.info('connection closed by peer during %s' % requestType)
+        finally:
+            connection.close()
 
     def _handleConnect(self, buffer, connection):
         """Handles connect message. Adds connection to peers list.
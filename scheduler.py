@@ -0,0 +1,176 @@
+# scheduler.py
+
+from enum import Enum
+from collections import OrderedDict, deque
+from threading import Condition
+from time import monotonic
+
+# transfer priority classes, highest first
+Priority = Enum('Priority', [
+    'INTERACTIVE',  # reads a user is waiting on
+    'WRITE',        # uploads
+    'BACKGROUND',   # maintenance such as repair
+])
+
+class TokenBucket:
+    """Rate limit of a number of bytes per second. A rate of None is unlimited.
+
+    Tokens may go negative so a transfer larger than the bucket is let through once and paid back before the next.
+
+    _rate:      bytes per second, None if unlimited
+    _capacity:  maximum tokens i.e. burst size
+    _tokens:    current tokens
+    _updated:   time tokens were last refilled
+    """
+
+    def __init__(self, rate=None):
+        self._updated = monotonic()
+        self.setRate(rate)
+
+    def setRate(self, rate):
+        self._rate = rate
+        self._capacity = max(rate, TransferScheduler.QUANTUM) if rate else None
+        self._tokens = self._capacity
+
+    def refill(self, now):
+        if self._rate:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def consume(self, nbytes):
+        if self._rate:
+            self._tokens -= nbytes
+
+    def delay(self):
+        """Returns seconds until bucket can be consumed from, 0 if it can be now."""
+        if not self._rate or self._tokens >= 0:
+            return 0
+        return -self._tokens / self._rate
+
+    @property
+    def rate(self):
+        return self._rate
+
+class TransferScheduler:
+    """Orders and rate limits data transfers of a node.
+
+    Transfers call acquire() before moving each chunk of at most QUANTUM bytes. Chunks are granted by priority class,
+    round robin between flows (e.g. files) of the same class, once both the global bucket and the bucket of the chunk's
+    peer have tokens. Rates can be changed at any time.
+
+    QUANTUM:            maximum bytes transferred per acquire()
+    _cond:              condition guarding all state, notified whenever a chunk is queued, granted or a rate changes
+    _globalBucket:      TokenBucket for all transfers
+    _peerBuckets:       map of peer host to TokenBucket
+    _peerRates:         map of peer host to rate set explicitly for it
+    _defaultPeerRate:   rate of peers without an explicit rate
+    _queues:            map of Priority to OrderedDict of flow to deque of waiting chunks, flows in round robin order
+    """
+
+    QUANTUM = 65536
+
+    def __init__(self, globalRate=None, peerRate=None):
+        """Creates a scheduler.
+
+        Args:
+            globalRate: bytes per second across all peers, default is None (unlimited)
+            peerRate: bytes per second to/from each peer, default is None (unlimited)
+        """
+        self._cond = Condition()
+        self._globalBucket = TokenBucket(globalRate)
+        self._peerBuckets = dict()
+        self._peerRates = dict()
+        self._defaultPeerRate = peerRate
+        self._queues = {priority: OrderedDict() for priority in Priority}
+
+    def acquire(self, host, nbytes, priority=Priority.WRITE, flow=None):
+        """Blocks until a chunk may be transferred.
+
+        Args:
+            host: peer host chunk is sent to or received from
+            nbytes: size of chunk
+            priority: Priority of transfer, default is Priority.WRITE
+            flow: key chunks are fairly queued by, e.g. filename, default is None
+        """
+        chunk = [host, nbytes]
+        with self._cond:
+            self._queues[priority].setdefault(flow, deque()).append(chunk)
+            self._cond.notify_all()
+            while True:
+                now = monotonic()
+                self._globalBucket.refill(now)
+                candidate, delay = self._next(now)
+                if candidate is not None and candidate[2] is chunk:
+                    break
+                # wait for candidate to be granted or a blocked chunk's buckets to refill, which may change the
+                # candidate without anything notifying
+                self._cond.wait(delay)
+            queue = self._queues[priority][flow]
+            queue.popleft()
+            if queue:
+                # flow goes to back of round robin
+                self._queues[priority].move_to_end(flow)
+            else:
+                del self._queues[priority][flow]
+            self._globalBucket.consume(nbytes)
+            self._peerBucket(host).consume(nbytes)
+            self._cond.notify_all()
+
+    def setGlobalRate(self, rate):
+        """Sets bytes per second across all peers, None for unlimited."""
+        with self._cond:
+            self._globalBucket.setRate(rate)
+            self._cond.notify_all()
+
+    def setPeerRate(self, host, rate):
+        """Sets bytes per second to/from a single peer host, None to use the default peer rate."""
+        with self._cond:
+            if rate is None:
+                self._peerRates.pop(host, None)
+            else:
+                self._peerRates[host] = rate
+            self._peerBucket(host).setRate(self._peerRates.get(host, self._defaultPeerRate))
+            self._cond.notify_all()
+
+    def setDefaultPeerRate(self, rate):
+        """Sets bytes per second to/from each peer without an explicit rate, None for unlimited."""
+        with self._cond:
+            self._defaultPeerRate = rate
+            for host, bucket in self._peerBuckets.items():
+                if host not in self._peerRates:
+                    bucket.setRate(rate)
+            self._cond.notify_all()
+
+    @property
+    def globalRate(self):
+        return self._globalBucket.rate
+
+    @property
+    def defaultPeerRate(self):
+        return self._defaultPeerRate
+
+    def _peerBucket(self, host):
+        if host not in self._peerBuckets:
+            self._peerBuckets[host] = TokenBucket(self._peerRates.get(host, self._defaultPeerRate))
+        return self._peerBuckets[host]
+
+    def _next(self, now):
+        """Finds the next chunk to grant. Must be called with _cond held.
+
+        Returns:
+            tuple of (priority, flow, chunk) or None if no chunk can be granted yet, and seconds until the first blocked
+            chunk may be granted or None if no chunk is blocked
+        """
+        globalDelay = self._globalBucket.delay()
+        candidate = None
+        delay = None
+        for priority in Priority:
+            for flow, queue in self._queues[priority].items():
+                bucket = self._peerBucket(queue[0][0])
+                bucket.refill(now)
+                chunkDelay = max(globalDelay, bucket.delay())
+                if chunkDelay > 0:
+                    delay = chunkDelay if delay is None else min(delay, chunkDelay)
+                elif candidate is None:
+                    candidate = (priority, flow, queue[0])
+        return candidate, delay
@@ -2,22 +2,43 @@
 
 from common import *    # RequestType, Fields, RequestFields
 from node import Node
+from storedfile import StoredFile
+from scheduler import TransferScheduler, Priority
+import merkle
 import os
 import socket
 import hashlib
 from enum import Enum
 import tempfile
+import shutil
 import random
+import queue
+import time
+from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.fernet import Fernet
 
 class StorageNode(Node):
     """A network node that facilitates distributed file storage.
 
+    PART_SIZE:          size of chunks files are split into when uploading
+    SYNC_CHECKPOINT:    tuple of number of files and seconds after which syncDirectory saves its progress
     _dataDir:           directory to be used for storing/retrieving data
-    _fileParts:         dict filename to file part hashes
+    _fileParts:         dict filename to manifest dict with keys 'parts' (list of part hashes), 'sizes' (list of
+                        decoded part sizes, None if unknown), 'encrypted', 'blocks' (list per part of merkle leaf
+                        hashes of its blocks, None if unknown) and 'root' (merkle root of file, None if unknown)
     _filePartsLoader:   file used to save _fileParts state in case Node is restarted
+    _scheduler:         TransferScheduler rate limiting and ordering data sent and received by this node
+    _journalDir:        directory holding per-part progress of interrupted uploads/downloads and downloaded parts
+    _syncCache:         dict full path of synced file to dict with keys 'stat' (size, mtime and inode when uploaded),
+                        'name' (name uploaded as), 'encrypted' and 'parts' (part hashes)
+    _syncCacheLoader:   file used to save _syncCache state
     """
 
+    PART_SIZE = 67108864
+    SYNC_CHECKPOINT = (100, 10)
+
     def __init__(self, dataDir, host=socket.gethostbyname(socket.gethostname()), port=8089):
         """Creates node with storage functionality.
 
@@ -32,7 +53,10 @@ class StorageNode(Node):
             RequestType.DATA_ADD    : self._handleDataAdd,
             RequestType.DATA_GET    : self._handleDataGet,
             RequestType.DATA_REMOVE : self._handleDataRemove,
+            RequestType.DATA_GET_RANGE : self._handleDataGetRange,
         })
+        self._threadedHandlers.update({RequestType.DATA_ADD, RequestType.DATA_GET, RequestType.DATA_GET_RANGE})
+        self._scheduler = TransferScheduler()
 
         self._dataDir = os.path.expandvars(dataDir)
         os.makedirs(self._dataDir, exist_ok=True)
@@ -44,104 +68,493 @@ class StorageNode(Node):
                 f.write(repr(dict()))
         # load existing dict into _fileParts
         self._fileParts = eval(open(self._filePartsLoader, 'r').read()) # TODO use pickle instead to
+        for basename, manifest in self._fileParts.items():
+            if isinstance(manifest, list):
+                # older loaders stored only the list of part hashes
+                self._fileParts[basename] = {'parts': manifest, 'sizes': None, 'encrypted': None, 'blocks': None, 'root': None}
+        self._journalDir = os.path.join(self._dataDir, '.journal')
+        os.makedirs(self._journalDir, exist_ok=True)
+        self._syncCacheLoader = os.path.join(self._dataDir, '.syncCache')
+        self._syncCache = dict()
+        if os.path.isfile(self._syncCacheLoader):
+            self._syncCache = eval(open(self._syncCacheLoader, 'r').read())
         self._logger.info('dataDir %s filePartsLoader %s' % (self._dataDir, self._filePartsLoader))
 
-    def uploadFile(self, filename, encrypt=False):
+    def uploadFile(self, filename, encrypt=False, name=None, save=True):
         """Uploads any file to the network.
 
+        Progress is journaled after each part is confirmed stored, so if an upload of the same unchanged file was
+        interrupted it continues from the first unconfirmed part.
+
         Args:
             filename: full path to file
             encrypt: whether or not file should be encrypted. default is False
+            name: name to store file under, default is filename without full path
+            save: whether to write _fileParts to _filePartsLoader once uploaded, default is True
+
+        Raises:
+            Exception: if a peer reports storing data with a different hash than was sent
         """
         filename = os.path.expandvars(filename)
-        basename = os.path.basename(filename)
-        self._logger.info('uploading file %s' % filename)
-        partSize = 67108864
-        parts = list()
-        if encrypt:
-            # generate key and save to filename.key
-            key = Fernet.generate_key()
-            keyfile = os.path.join(self._dataDir, basename) + '.key'
-            open(keyfile, 'w+b').write(key)
-            self._logger.info('IMPORTANT!!! saved key to %s' % keyfile)
+        basename = name or os.path.basename(filename)
+        self._logger.info('uploading file %s as %s' % (filename, basename))
+        stat = os.stat(filename)
+        journal = self._loadJournal(basename, 'upload')
+        if journal and (journal['filename'], journal['size'], journal['mtime'], journal['encrypted']) != (filename, stat.st_size, stat.st_mtime, encrypt):
+            self._logger.info('%s changed since interrupted upload, starting over' % filename)
+            journal = None
+        keyfile = os.path.join(self._dataDir, basename) + '.key'
+        if journal and encrypt:
+            # confirmed parts were encrypted with the saved key, keep using it
+            key = self._loadKey(basename)
+            if not key:
+                journal = None
+        if not journal:
+            journal = {'filename': filename, 'size': stat.st_size, 'mtime': stat.st_mtime, 'encrypted': encrypt, 'parts': list(), 'sizes': list(), 'blocks': list(), 'stored': dict()}
+            if encrypt:
+                # generate key and save to filename.key
+                key = Fernet.generate_key()
+                os.makedirs(os.path.dirname(keyfile), exist_ok=True)
+                open(keyfile, 'w+b').write(key)
+                self._logger.info('IMPORTANT!!! saved key to %s' % keyfile)
+        elif journal['parts']:
+            self._logger.info('resuming upload of %s after %s confirmed parts' % (filename, len(journal['parts'])))
 
         with open(filename, 'rb') as f:
-            # read and send file data to network in partSize chunks
+            # skip parts already confirmed stored
+            f.seek(sum(journal['sizes']))
+            # read and send file data to network in PART_SIZE chunks
             while True:
-                buffer = f.read(partSize)
+                buffer = f.read(StorageNode.PART_SIZE)
                 if not buffer:
                     # finished reading file
                     break
 
+                partSize = len(buffer)
                 if encrypt:
                     buffer = Fernet(key).encrypt(buffer)
+                filehash, blocks = merkle.hashPart(buffer)
 
+                storedOn = list()
                 for host, port in self._chooseNode():
                     self._logger.debug('sending part to %s:%s' % (host, port))
-                    self.sendDataAdd(host, port, bytedata=buffer)
+                    storedHash = self.sendDataAdd(host, port, bytedata=buffer, flow=basename)
+                    if storedHash != filehash:
+                        raise Exception('%s:%s stored %s, expected %s' % (host, port, storedHash, filehash))
+                    storedOn.append((host, port))
 
-                # save chunk's hash to list (list to preserve order)
-                filehash = hashlib.sha256(buffer).hexdigest()
+                # save chunk's hash to list (list to preserve order) and checkpoint
                 self._logger.debug('sent %s' % filehash)
-                parts.append(filehash)
+                journal['parts'].append(filehash)
+                journal['sizes'].append(partSize)
+                journal['blocks'].append(blocks)
+                journal['stored'][filehash] = storedOn
+                self._saveJournal(basename, 'upload', journal)
 
         # assign list of chunk hashes to filename key
-        self._fileParts[basename] = parts
-        open(self._filePartsLoader, 'w').write(repr(self._fileParts))
+        self._fileParts[basename] = {'parts': journal['parts'], 'sizes': journal['sizes'], 'encrypted': encrypt, 'blocks': journal['blocks'], 'root': merkle.fileRoot(journal['blocks'])}
+        if save:
+            self._saveFileParts()
+        self._removeJournal(basename, 'upload')
         self._logger.info('done uploading file %s' % filename)
 
+    def syncDirectory(self, path, encrypt=False, workers=8):
+        """Uploads new and changed files under a directory. Files are stored under their path relative to the directory.
+
+        A file is unchanged, and is not read, if its size, mtime and inode match those recorded when it was last
+        uploaded with the same encrypt setting and its parts are still what is stored under its name. Files that
+        vanish or cannot be read while syncing are skipped. Progress is saved every SYNC_CHECKPOINT and when done.
+
+        Args:
+            path: directory to sync
+            encrypt: whether or not uploaded files should be encrypted, default is False
+            workers: number of threads walking the directory, default is 8
+
+        Returns:
+            list of names of uploaded files
+        """
+        path = os.path.abspath(os.path.expandvars(path))
+        self._logger.info('syncing %s' % path)
+        uploaded = list()
+        unsaved = 0
+        lastSaved = time.monotonic()
+        try:
+            for filename, stat in sorted(self._walkDirectory(path, workers)):
+                name = os.path.relpath(filename, path)
+                fileStat = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino}
+                cached = self._syncCache.get(filename)
+                manifest = self._fileParts.get(name)
+                if cached and manifest and (cached['stat'], cached['name'], cached['encrypted'], cached['parts']) == (fileStat, name, encrypt, manifest['parts']):
+                    continue
+                try:
+                    self.uploadFile(filename, encrypt=encrypt, name=name, save=False)
+                except OSError as e:
+                    # e.g. removed or made unreadable since the directory was walked
+                    self._logger.info('skipping %s: %s' % (filename, e))
+                    continue
+                # record stat from before the file was read so changes made while uploading are picked up next sync
+                self._syncCache[filename] = {'stat': fileStat, 'name': name, 'encrypted': encrypt, 'parts': self._fileParts[name]['parts']}
+                uploaded.append(name)
+                unsaved += 1
+                # rewriting the manifest and cache after every file would make a first sync quadratic in file count
+                if unsaved >= StorageNode.SYNC_CHECKPOINT[0] or time.monotonic() - lastSaved >= StorageNode.SYNC_CHECKPOINT[1]:
+                    self._saveSyncState()
+                    unsaved = 0
+                    lastSaved = time.monotonic()
+        finally:
+            if unsaved:
+                self._saveSyncState()
+        self._logger.info('synced %s, uploaded %s files' % (path, len(uploaded)))
+        return uploaded
+
     def downloadFile(self, basename, outfile, decrypt=False):
         """Request file from network by name.
 
+        Received parts are verified block by block against the file's merkle tree (or, for files uploaded without one,
+        against their hashes) and journaled. If some parts cannot be found, the verified
+        parts are kept and a later call only requests the remaining ones.
+
         Args:
             basename: filename without full path
             outfile: target file to download data to
             decrypt: whether or not file needs to be decrypted, default is False
+
+        Returns:
+            True if file was written to outfile, False otherwise
         """
-        #TODO raise or return False if file not found
         self._logger.info('downloading %s' % basename)
+        if basename not in self._fileParts:
+            self._logger.info('file %s not found' % basename)
+            return False
         if decrypt:
-            keyfile = os.path.join(self._dataDir, basename + '.key')
-            try:
-                key = open(keyfile, 'rb').read()
-            except FileNotFoundError:
-                self._logger.info('key not found at %s' % keyfile)
-                return
-        partsfound = dict()
+            key = self._loadKey(basename)
+            if not key:
+                return False
+        parts = self._fileParts[basename]['parts']
+        partBlocks = dict(zip(parts, self._fileParts[basename]['blocks'] or list()))
+        partDir = os.path.join(self._journalDir, basename + '.parts')
+        os.makedirs(partDir, exist_ok=True)
+        journal = self._loadJournal(basename, 'download')
+        if not journal or journal['parts'] != parts:
+            journal = {'parts': parts, 'verified': list()}
+        # only trust journaled parts still on disk
+        verified = set(filter(lambda partHash: os.path.isfile(os.path.join(partDir, partHash)), journal['verified']))
+        if verified:
+            self._logger.info('resuming download of %s with %s verified parts' % (basename, len(verified)))
         # go by host
-        for host, port in self._peers:
+        for host, port in list(self._peers):
             # get all files you can from host
-            for partHash in set(self._fileParts[basename]) - set(partsfound.keys()):
+            for partHash in set(parts) - verified:
                 self._logger.debug('requesting %s from %s:%s' % (partHash, host, port))
-                recvfile = self.sendDataGet(host, port, partHash)
-                if recvfile:
-                    partsfound[partHash] = recvfile
-                    self._logger.info('found %s' % partHash)
+                try:
+                    recvfile = self.sendDataGet(host, port, partHash, os.path.join(partDir, partHash), blocks=partBlocks.get(partHash), flow=basename)
+                except OSError as e:
+                    # peer unreachable or dropped the connection, try remaining parts on the next peer
+                    self._logger.info('failed to get %s from %s:%s: %s' % (partHash, host, port, e))
+                    break
+                if not recvfile:
+                    continue
+                if partHash not in partBlocks and self._hashFile(recvfile) != partHash:
+                    self._logger.info('%s from %s:%s failed verification' % (partHash, host, port))
+                    os.remove(recvfile)
+                    continue
+                self._logger.info('found %s' % partHash)
+                verified.add(partHash)
+                journal['verified'] = list(verified)
+                self._saveJournal(basename, 'download', journal)
 
         # confirm all files were found
-        if (len(partsfound) != len(self._fileParts[basename])):
-            self._logger.info('unable to find all file parts')
-        else:
-            # write files sequentially to outfile
-            outfile = os.path.expandvars(outfile)
-            with open(outfile, 'w+b') as f:
-                self._logger.info('writing parts to %s' % outfile)
-                for partHash in self._fileParts[basename]:
-                    partRead = open(partsfound[partHash], 'rb').read()
-                    if decrypt:
-                        f.write(Fernet(key).decrypt(partRead))
-                    else:
-                        f.write(partRead)
+        if (len(verified) != len(set(parts))):
+            self._logger.info('unable to find all file parts, %s of %s verified parts kept for resuming' % (len(verified), len(set(parts))))
+            return False
+        # write files sequentially to outfile
+        outfile = os.path.expandvars(outfile)
+        with open(outfile, 'w+b') as f:
+            self._logger.info('writing parts to %s' % outfile)
+            for partHash in parts:
+                partRead = open(os.path.join(partDir, partHash), 'rb').read()
+                if decrypt:
+                    f.write(Fernet(key).decrypt(partRead))
+                else:
+                    f.write(partRead)
         # remove downloaded parts
-        for _, filename in partsfound.items():
-            self._logger.debug('removing %s' % filename)
-            os.remove(filename)
+        self._logger.debug('removing %s' % partDir)
+        shutil.rmtree(partDir)
+        self._removeJournal(basename, 'download')
+        return True
+
+    def open(self, basename, cacheSize=None, readahead=None):
+        """Opens a file stored on the network for random-access reading. Only data covering reads is fetched.
+
+        Args:
+            basename: filename without full path
+            cacheSize: number of fetched blocks (whole parts if encrypted) kept in memory, default is
+                StoredFile.CACHE_UNITS
+            readahead: number of blocks (whole parts if encrypted) prefetched ahead of sequential reads, default is
+                StoredFile.READAHEAD_UNITS
+
+        Returns:
+            seekable, read-only StoredFile
+
+        Raises:
+            Exception: if file is unknown or its part sizes or merkle tree were not recorded
+        """
+        self._logger.info('opening %s' % basename)
+        manifest = self._fileParts.get(basename)
+        if manifest is None:
+            raise Exception('file %s not found' % basename)
+        if manifest['sizes'] is None:
+            raise Exception('part sizes of %s were not recorded, reupload to open' % basename)
+        if manifest['blocks'] is None:
+            # ranged reads could not be verified
+            raise Exception('merkle tree of %s was not recorded, reupload to open' % basename)
+        key = None
+        if manifest['encrypted']:
+            key = self._loadKey(basename)
+            if not key:
+                raise Exception('key for %s not found' % basename)
+        return StoredFile(self, manifest['parts'], manifest['sizes'], blocks=manifest['blocks'], key=key, cacheSize=cacheSize, readahead=readahead)
+
+    def verifyFile(self, basename, root=None, workers=os.cpu_count()):
+        """Verifies a stored file against a single merkle root by retrieving and checking every block of every part.
+
+        Args:
+            basename: filename without full path
+            root: expected merkle root, default is the root recorded when file was uploaded
+            workers: number of parts retrieved and checked at once, default is number of cores
+
+        Returns:
+            True if tree matches root and every part was found with every replica intact, False otherwise
+
+        Raises:
+            Exception: if file is unknown or was uploaded without a merkle tree
+        """
+        self._logger.info('verifying %s' % basename)
+        manifest = self._fileParts.get(basename)
+        if manifest is None:
+            raise Exception('file %s not found' % basename)
+        if manifest['blocks'] is None:
+            raise Exception('merkle tree of %s was not recorded, reupload to verify' % basename)
+        root = root or manifest['root']
+        if merkle.fileRoot(manifest['blocks']) != root:
+            self._logger.info('merkle tree of %s does not match root %s' % (basename, root))
+            return False
+        partBlocks = dict(zip(manifest['parts'], manifest['blocks']))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            # check every part, even after one fails, so every corrupt replica is reported
+            intact = all(list(executor.map(lambda partHash: self._verifyPart(basename, partHash, partBlocks[partHash]), partBlocks)))
+        if intact:
+            self._logger.info('verified %s' % basename)
+        return intact
+
+    def _verifyPart(self, basename, partHash, blocks):
+        """Retrieves every replica of a part, checking every block without repairing any. Logs each corrupt replica.
+
+        Args:
+            basename: filename part belongs to
+            partHash: hash of part
+            blocks: merkle leaf hashes of part's blocks
+
+        Returns:
+            True if at least one replica was found and every replica found is intact, False otherwise
+        """
+        fd, targetfile = tempfile.mkstemp()
+        os.close(fd)
+        intact = list()
+        corrupt = list()
+        try:
+            for host, port in list(self._peers):
+                try:
+                    recvfile = self.sendDataGet(host, port, partHash, targetfile, blocks=blocks, priority=Priority.BACKGROUND, flow=basename, repair=False)
+                except OSError as e:
+                    self._logger.info('failed to get %s from %s:%s: %s' % (partHash, host, port, e))
+                    continue
+                if recvfile:
+                    intact.append((host, port))
+                elif recvfile is False:
+                    self._logger.info('replica of %s on %s:%s is corrupt' % (partHash, host, port))
+                    corrupt.append((host, port))
+        finally:
+            if os.path.isfile(targetfile):
+                os.remove(targetfile)
+        if not intact:
+            self._logger.info('unable to retrieve intact %s' % partHash)
+        return bool(intact) and not corrupt
 
     def removeFile(self, basename):
         self._logger.info('removing file %s from network' % basename)
-        for filehash in self._fileParts[basename]:
+        for filehash in self._fileParts[basename]['parts']:
             list(map(lambda hp: self.sendDataRemove(hp[0], hp[1], filehash), self._peers))
         self._fileParts.pop(basename, None)
+        self._saveFileParts()
+
+    def _saveFileParts(self):
+        """Writes _fileParts to _filePartsLoader."""
+        self._writeAtomic(self._filePartsLoader, repr(self._fileParts))
+
+    def _saveSyncState(self):
+        """Writes _fileParts and then _syncCache, so the cache never refers to parts missing from the manifest."""
+        self._saveFileParts()
+        self._writeAtomic(self._syncCacheLoader, repr(self._syncCache))
+
+    def _journalFile(self, basename, kind):
+        return os.path.join(self._journalDir, '%s.%s' % (basename, kind))
+
+    def _loadJournal(self, basename, kind):
+        """Reads progress of an interrupted transfer.
+
+        Args:
+            basename: filename without full path
+            kind: 'upload' or 'download'
+
+        Returns:
+            journal dict, None if there is no journal
+        """
+        journalFile = self._journalFile(basename, kind)
+        if not os.path.isfile(journalFile):
+            return None
+        return eval(open(journalFile, 'r').read())
+
+    def _saveJournal(self, basename, kind, journal):
+        """Writes progress of a transfer."""
+        journalFile = self._journalFile(basename, kind)
+        os.makedirs(os.path.dirname(journalFile), exist_ok=True)
+        self._writeAtomic(journalFile, repr(journal))
+
+    def _writeAtomic(self, filename, text):
+        """Replaces a file's contents so that an interruption while writing leaves the previous contents intact."""
+        open(filename + '.tmp', 'w').write(text)
+        os.replace(filename + '.tmp', filename)
+
+    def _walkDirectory(self, path, workers):
+        """Lists regular files under a directory, scanning subdirectories in parallel. Symlinks are not followed.
+
+        Args:
+            path: directory to walk
+            workers: number of scanning threads
+
+        Returns:
+            list of (full path, os.stat_result) tuples
+        """
+        directories = queue.Queue()
+        directories.put(path)
+        files = list()
+
+        def scan():
+            while True:
+                directory = directories.get()
+                if directory is None:
+                    return
+                try:
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    directories.put(entry.path)
+                                elif entry.is_file(follow_symlinks=False):
+                                    files.append((entry.path, entry.stat(follow_symlinks=False)))
+                            except OSError as e:
+                                # e.g. removed since directory was listed, the rest of the directory is still scanned
+                                self._logger.info('failed to scan %s: %s' % (entry.path, e))
+                except OSError as e:
+                    self._logger.info('failed to scan %s: %s' % (directory, e))
+                finally:
+                    directories.task_done()
+
+        threads = [Thread(target=scan) for _ in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        directories.join()
+        # stop scanning threads
+        for thread in threads:
+            directories.put(None)
+        for thread in threads:
+            thread.join()
+        return files
+
+    def _removeJournal(self, basename, kind):
+        try:
+            os.remove(self._journalFile(basename, kind))
+        except FileNotFoundError:
+            pass
+
+    def _checkBlock(self, tmp, datahash, blocks, peer, repair, index, offset, length, leafHash):
+        """Checks a block written to a file against its merkle leaf hash, replacing it in the file if corrupt.
+
+        Args:
+            tmp: file object block was written to
+            datahash: hash of data block is in
+            blocks: merkle leaf hashes of data's blocks
+            peer: peer block was received from
+            repair: whether to replace a corrupt block with an intact one from another peer
+            index: index of block in data
+            offset: offset of block in tmp
+            length: size of block
+            leafHash: Future of leaf hash of received block
+
+        Returns:
+            True if block is intact or was replaced with an intact copy, False otherwise
+        """
+        if leafHash.result() == blocks[index]:
+            return True
+        self._logger.info('block %s of %s from %s:%s failed verification' % (index, datahash, *peer))
+        if not repair:
+            return False
+        block = self._fetchBlock(datahash, index, length, blocks[index], peer)
+        if block is None:
+            return False
+        tmp.flush()
+        os.pwrite(tmp.fileno(), block, offset)
+        return True
+
+    def _fetchBlock(self, datahash, index, length, blockHash, exclude):
+        """Retrieves a single block of data from any peer other than one that sent it corrupted.
+
+        Args:
+            datahash: hash of data block is in
+            index: index of block in data
+            length: size of block
+            blockHash: expected merkle leaf hash of block
+            exclude: peer to skip
+
+        Returns:
+            block bytes, None if no peer has an intact copy
+        """
+        for host, port in list(self._peers):
+            if (host, port) == exclude:
+                continue
+            try:
+                data = self.sendDataGetRange(host, port, datahash, index * merkle.BLOCK_SIZE, length)
+            except OSError:
+                continue
+            if data is not None and merkle.hashBlock(data) == blockHash:
+                self._logger.info('refetched block %s of %s from %s:%s' % (index, datahash, host, port))
+                return data
+        return None
+
+    def _hashFile(self, filename):
+        """Returns sha256 hex digest of a file's contents."""
+        filehash = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            while True:
+                data = f.read(1048576)
+                if not data:
+                    break
+                filehash.update(data)
+        return filehash.hexdigest()
+
+    def _loadKey(self, basename):
+        """Reads key saved for an encrypted file.
+
+        Returns:
+            key, None if key file does not exist
+        """
+        keyfile = os.path.join(self._dataDir, basename + '.key')
+        try:
+            return open(keyfile, 'rb').read()
+        except FileNotFoundError:
+            self._logger.info('key not found at %s' % keyfile)
+            return None
 
     def _chooseNode(self):
         """Get list of nodes to which files will be uploaded.
@@ -150,9 +563,9 @@ class StorageNode(Node):
             list of nodes
         """
         #TODO make customizable/configurable by file using a set of conditions/criteria
-        return random.sample(self._peers, 1)
+        return random.sample(list(self._peers), 1)
 
-    def sendDataAdd(self, host, port, filename='', bytedata=''):
+    def sendDataAdd(self, host, port, filename='', bytedata='', priority=Priority.WRITE, flow=None):
         """Send data for storage to single peer. Sends filename if provided, otherwise sends byte data.
 
         Args:
@@ -160,6 +573,11 @@ class StorageNode(Node):
             port: target peer port
             filename: full path of file to send, prioritized over bytedata, default is empty
             bytedata: encoded string to send as data, default is empty
+            priority: scheduler Priority of transfer, default is Priority.WRITE
+            flow: key transfer is fairly queued by in scheduler, default is None
+
+        Returns:
+            hash of data as stored by peer, used to confirm data was stored
         """
         self._logger.info('sending data add to %s:%s' % (host, port))
         clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -175,30 +593,52 @@ class StorageNode(Node):
             with open(filename, 'rb') as f:
                 while bytesRemaining:
                     assert(bytesRemaining > 0)
-                    data = f.read(4096)
-                    clientSocket.send(data)
+                    data = f.read(TransferScheduler.QUANTUM)
+                    self._scheduler.acquire(host, len(data), priority, flow)
+                    clientSocket.sendall(data)
                     bytesRemaining -= len(data)
         elif bytedata:
             buffer = StorageNode.DELIM.join(map(str, (RequestType.DATA_ADD.value, len(bytedata)))) + StorageNode.DELIM
-            buffer = buffer.encode()
-            buffer += bytedata
-            clientSocket.send(buffer)
+            clientSocket.send(buffer.encode())
+            view = memoryview(bytedata)
+            for start in range(0, len(view), TransferScheduler.QUANTUM):
+                data = view[start:start + TransferScheduler.QUANTUM]
+                self._scheduler.acquire(host, len(data), priority, flow)
+                clientSocket.sendall(data)
         else:
             #TODO raise
             assert(False)
+        # peer responds with hash of stored data once it is written
+        DELIM_ENCODED = Node.DELIM.encode()
+        recvBuffer = b''
+        while (recvBuffer.count(DELIM_ENCODED) <= 0):
+            recvData = clientSocket.recv(4096)
+            if not recvData:
+                clientSocket.close()
+                raise ConnectionError('%s:%s closed connection before confirming data add' % (host, port))
+            recvBuffer += recvData
         clientSocket.close()
+        return recvBuffer.split(DELIM_ENCODED)[0].decode()
 
-    def sendDataGet(self, host, port, datahash, targetfile=None):
+    def sendDataGet(self, host, port, datahash, targetfile=None, blocks=None, priority=Priority.INTERACTIVE, flow=None, repair=True):
         """Send a data retrieval request to a single peer.
 
+        If blocks are provided, each block is verified as it is received, hashing up to merkle.PENDING_BLOCKS blocks
+        in parallel, and a corrupt block is refetched from another peer unless repair is False.
+
         Args:
             host: target peer address
             port: target peer port
             datahash: hash of data to retrieve
             targetfile: target path to write data to, default is self._dataDir/<datahash>
+            blocks: merkle leaf hashes of data's blocks, default is None (not verified)
+            priority: scheduler Priority of transfer on both peers, default is Priority.INTERACTIVE
+            flow: key transfer is fairly queued by in scheduler, default is None
+            repair: whether to replace corrupt blocks with intact ones from other peers, default is True
 
         Returns:
-            full filename of where data was written
+            full filename of where data was written, None if peer does not have data, False if peer's data failed
+            verification (and could not be repaired)
         """
         # get target file
         if not targetfile:
@@ -207,7 +647,7 @@ class StorageNode(Node):
 
         # create and send request message
         self._logger.info('requesting data from %s:%s (%s)' % (host, port, datahash))
-        buffer = StorageNode.DELIM.join(map(str, (RequestType.DATA_GET.value, datahash))) + StorageNode.DELIM
+        buffer = StorageNode.DELIM.join(map(str, (RequestType.DATA_GET.value, datahash, priority.value))) + StorageNode.DELIM
         clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         clientSocket.connect((host, port))
         clientSocket.send(buffer.encode())
@@ -216,9 +656,14 @@ class StorageNode(Node):
         self._logger.info('receiving')
         # read data size, keep recv'ing until data size can be parsed (see common.py for info on message types and structure)
         DELIM_ENCODED = Node.DELIM.encode()
-        recvBuffer = clientSocket.recv(4096)
+        recvBuffer = b''
         while (recvBuffer.count(DELIM_ENCODED) <= 0):
-            recvBuffer += clientSocket.recv(4096)
+            recvData = clientSocket.recv(4096)
+            if not recvData:
+                # e.g. peer failed handling the request
+                clientSocket.close()
+                raise ConnectionError('connection closed before data size was received')
+            recvBuffer += recvData
         dataSize = int(recvBuffer.split(DELIM_ENCODED)[0].decode())
         if (dataSize == 0):
             self._logger.debug('node does not have data')
@@ -227,14 +672,46 @@ class StorageNode(Node):
         # read data
         # have to join after split in case has buffer has DELIM_ENCODED as a byte value
         data = DELIM_ENCODED.join(recvBuffer.split(DELIM_ENCODED)[1:])
+        if blocks is not None and len(blocks) != merkle.blockCount(dataSize):
+            self._logger.info('%s:%s sent %s bytes, expected %s blocks' % (host, port, dataSize, len(blocks)))
+            clientSocket.close()
+            return False
         tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
+        totalBytesReceived = len(data)
         totalBytesWritten = 0
-        totalBytesWritten += tmp.write(data)
+        blockIndex = 0
+        pending = bytearray(data)
+        # blocks written but not yet checked, in order, as (index, offset, length, Future of leaf hash)
+        checks = deque()
         # keep reading until dataSize bytes are read from incoming buffer
         #TODO set timeout for partial reads
-        while (totalBytesWritten < dataSize):
-            data = clientSocket.recv(4096)
-            totalBytesWritten += tmp.write(data)
+        while True:
+            # write received data, block by block once complete if verifying
+            while pending and (blocks is None or len(pending) >= merkle.BLOCK_SIZE or totalBytesReceived == dataSize):
+                block = bytes(pending[:merkle.BLOCK_SIZE]) if blocks is not None else bytes(pending)
+                del pending[:len(block)]
+                if blocks is not None:
+                    checks.append((blockIndex, totalBytesWritten, len(block), merkle.submitBlock(block)))
+                totalBytesWritten += tmp.write(block)
+                blockIndex += 1
+            # check hashed blocks, waiting on the oldest only if too many are pending or all data is received
+            while checks and (checks[0][3].done() or len(checks) > merkle.PENDING_BLOCKS or totalBytesReceived >= dataSize):
+                if not self._checkBlock(tmp, datahash, blocks, (host, port), repair, *checks.popleft()):
+                    clientSocket.close()
+                    tmp.close()
+                    os.remove(tmp.name)
+                    return False
+            if totalBytesReceived >= dataSize:
+                break
+            data = clientSocket.recv(TransferScheduler.QUANTUM)
+            if not data:
+                clientSocket.close()
+                tmp.close()
+                os.remove(tmp.name)
+                raise ConnectionError('connection closed after %s of %s bytes' % (totalBytesReceived, dataSize))
+            self._scheduler.acquire(host, len(data), priority, flow)
+            totalBytesReceived += len(data)
+            pending += data
         assert(totalBytesWritten == dataSize)
         # move temp file to target location and cleanup
         os.rename(tmp.name, targetfile)
@@ -242,6 +719,53 @@ class StorageNode(Node):
         clientSocket.close()
         return targetfile
 
+    def sendDataGetRange(self, host, port, datahash, offset, length, priority=Priority.INTERACTIVE, flow=None):
+        """Send a request for a byte range of data to a single peer.
+
+        Args:
+            host: target peer address
+            port: target peer port
+            datahash: hash of data to retrieve
+            offset: offset in data of first byte to retrieve
+            length: number of bytes to retrieve
+            priority: scheduler Priority of transfer on both peers, default is Priority.INTERACTIVE
+            flow: key transfer is fairly queued by in scheduler, default is None
+
+        Returns:
+            bytes received (fewer than length if range extends past end of data), None if peer does not have data
+        """
+        self._logger.info('requesting %s bytes at %s from %s:%s (%s)' % (length, offset, host, port, datahash))
+        buffer = StorageNode.DELIM.join(map(str, (RequestType.DATA_GET_RANGE.value, datahash, offset, length, priority.value))) + StorageNode.DELIM
+        clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        clientSocket.connect((host, port))
+        clientSocket.send(buffer.encode())
+
+        # response is the same as for DATA_GET: data size followed by data, size of 0 if data not found
+        DELIM_ENCODED = Node.DELIM.encode()
+        recvBuffer = b''
+        while (recvBuffer.count(DELIM_ENCODED) <= 0):
+            recvData = clientSocket.recv(4096)
+            if not recvData:
+                # e.g. peer failed handling the request
+                clientSocket.close()
+                raise ConnectionError('connection closed before data size was received')
+            recvBuffer += recvData
+        dataSize = int(recvBuffer.split(DELIM_ENCODED)[0].decode())
+        if (dataSize == 0):
+            self._logger.debug('node does not have data')
+            clientSocket.close()
+            return None
+        data = bytearray(recvBuffer[recvBuffer.index(DELIM_ENCODED) + 1:])
+        while (len(data) < dataSize):
+            recvData = clientSocket.recv(min(TransferScheduler.QUANTUM, dataSize - len(data)))
+            if not recvData:
+                clientSocket.close()
+                raise ConnectionError('connection closed after %s of %s bytes' % (len(data), dataSize))
+            self._scheduler.acquire(host, len(recvData), priority, flow)
+            data += recvData
+        clientSocket.close()
+        return bytes(data)
+
     def sendDataRemove(self, host, port, datahash):
         """Send request to remove data from storage.
 
@@ -272,22 +796,35 @@ class StorageNode(Node):
         dataSize = int(buffer.split(DELIM_ENCODED)[Fields[RequestType.DATA_ADD].SIZE.value].decode())
         # have to join after split in case has buffer has DELIM_ENCODED as a byte value
         data = DELIM_ENCODED.join(buffer.split(DELIM_ENCODED)[Fields[RequestType.DATA_ADD].DATA.value:])
-        # write to temporary file
-        tmp = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-        totalBytesWritten = 0
-        totalBytesWritten += tmp.write(data)
-        # datahash will be output filename
-        datahash = hashlib.sha256()
-        datahash.update(data)
-        # while dataSize bytes not written, keep recv'ing and writing
-        while (totalBytesWritten < dataSize):
-            data = connection.recv(4096)
+        # write to temporary file in _dataDir so it can be linked into place atomically
+        tmp = tempfile.NamedTemporaryFile(mode='w+b', dir=self._dataDir, prefix='.', suffix='.tmp', delete=False)
+        try:
+            totalBytesWritten = 0
             totalBytesWritten += tmp.write(data)
+            # datahash will be output filename
+            datahash = hashlib.sha256()
             datahash.update(data)
-        outfilename = os.path.join(self._dataDir, datahash.hexdigest())
-        os.rename(tmp.name, outfilename)
-        tmp.close()
-        assert(totalBytesWritten == dataSize)
+            # while dataSize bytes not written, keep recv'ing and writing
+            while (totalBytesWritten < dataSize):
+                data = connection.recv(TransferScheduler.QUANTUM)
+                if not data:
+                    raise ConnectionResetError('connection closed after %s of %s bytes' % (totalBytesWritten, dataSize))
+                totalBytesWritten += tmp.write(data)
+                datahash.update(data)
+            tmp.close()
+            assert(totalBytesWritten == dataSize)
+            outfilename = os.path.join(self._dataDir, datahash.hexdigest())
+            try:
+                # data is stored by hash, so if another handler (or worker process) stored it first it is identical
+                os.link(tmp.name, outfilename)
+            except FileExistsError:
+                self._logger.debug('%s already stored' % outfilename)
+        finally:
+            tmp.close()
+            os.remove(tmp.name)
+        # confirm data add to sender
+        outbuffer = datahash.hexdigest() + StorageNode.DELIM
+        connection.send(outbuffer.encode())
 
     def _handleDataGet(self, buffer, connection):
         """Handle incoming request to send data.
@@ -300,7 +837,10 @@ class StorageNode(Node):
         buffer = buffer.decode()
         while (buffer.count(Node.DELIM) != len(Fields[RequestType.DATA_GET])):
             buffer += connection.recv(4096).decode()
-        filename = buffer.split(StorageNode.DELIM)[Fields[RequestType.DATA_GET].HASH.value]
+        fields = buffer.split(StorageNode.DELIM)
+        filename = fields[Fields[RequestType.DATA_GET].HASH.value]
+        # send at the priority of the requesting transfer
+        priority = Priority(int(fields[Fields[RequestType.DATA_GET].PRIORITY.value]))
         fullfile = os.path.join(self._dataDir, filename)
         if not os.path.isfile(fullfile):
             # file does not exist in node's storage, send 0 buffer to notify connection
@@ -311,17 +851,55 @@ class StorageNode(Node):
             return
         # read file and send data in chunks
         self._logger.info('found file %s' % fullfile)
+        host = connection.getpeername()[0]
         bytesRemaining = os.path.getsize(fullfile)
         outbuffer = str(bytesRemaining) + StorageNode.DELIM
         connection.send(outbuffer.encode())
         with open(fullfile, 'rb') as f:
             while bytesRemaining:
-                data = f.read(4096)
-                connection.send(data)
+                data = f.read(TransferScheduler.QUANTUM)
+                self._scheduler.acquire(host, len(data), priority, filename)
+                connection.sendall(data)
                 bytesRemaining -= len(data)
                 assert(bytesRemaining >= 0)
             assert(bytesRemaining == 0)
 
+    def _handleDataGetRange(self, buffer, connection):
+        """Handle incoming request to send a byte range of data.
+
+        Args:
+            buffer: socket buffer
+            connection: connection socket
+        """
+        buffer = buffer.decode()
+        while (buffer.count(Node.DELIM) != len(Fields[RequestType.DATA_GET_RANGE])):
+            buffer += connection.recv(4096).decode()
+        fields = buffer.split(StorageNode.DELIM)
+        filename = fields[Fields[RequestType.DATA_GET_RANGE].HASH.value]
+        offset = int(fields[Fields[RequestType.DATA_GET_RANGE].OFFSET.value])
+        length = int(fields[Fields[RequestType.DATA_GET_RANGE].LENGTH.value])
+        priority = Priority(int(fields[Fields[RequestType.DATA_GET_RANGE].PRIORITY.value]))
+        fullfile = os.path.join(self._dataDir, filename)
+        if not os.path.isfile(fullfile):
+            self._logger.info('failed to find file %s' % fullfile)
+            outbuffer = '0' + StorageNode.DELIM
+            connection.send(outbuffer.encode())
+            return
+        # clamp range to end of file
+        bytesRemaining = max(0, min(length, os.path.getsize(fullfile) - offset))
+        self._logger.info('sending %s bytes at %s of %s' % (bytesRemaining, offset, fullfile))
+        outbuffer = str(bytesRemaining) + StorageNode.DELIM
+        connection.send(outbuffer.encode())
+        host = connection.getpeername()[0]
+        with open(fullfile, 'rb') as f:
+            f.seek(offset)
+            while bytesRemaining:
+                data = f.read(min(TransferScheduler.QUANTUM, bytesRemaining))
+                self._scheduler.acquire(host, len(data), priority, filename)
+                connection.sendall(data)
+                bytesRemaining -= len(data)
+                assert(bytesRemaining >= 0)
+
     def _handleDataRemove(self, buffer, connection):
         """Handle incoming request to remove file from storage.
 
@@ -343,9 +921,13 @@ class StorageNode(Node):
     def dataDir(self):
         return self._dataDir
 
+    @property
+    def scheduler(self):
+        return self._scheduler
+
     @property
     def filePartsLoader(self):
-        return self._filePartsLoder
+        return self._filePartsLoader
 
     def storedData(self):
         return list(filter(os.path.isfile, os.listdir(self._dataDir)))
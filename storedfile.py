@@ -0,0 +1,269 @@
+# storedfile.py
+
+import io
+import os
+import bisect
+import tempfile
+from collections import OrderedDict
+from threading import Thread, Lock, Event
+from cryptography.fernet import Fernet
+import merkle
+
+class StoredFile(io.RawIOBase):
+    """A seekable, read-only file-like view of a file stored on the network.
+
+    Byte offsets are mapped to parts using the part sizes recorded in the owning StorageNode's manifest. Only the
+    parts (or, for unencrypted files, BLOCK_SIZE sub-ranges of parts) covering a read are fetched. Fetched units are
+    kept in a small LRU and, on sequential reads, the next units are prefetched on background threads.
+
+    BLOCK_SIZE:     size of sub-range fetched at a time from unencrypted parts
+    CACHE_UNITS:    default _cacheSize, for unencrypted (blocks) and encrypted (whole parts) files
+    READAHEAD_UNITS: default _readahead, for unencrypted (blocks) and encrypted (whole parts) files
+    _node:          StorageNode used to fetch data
+    _parts:         list of part hashes in file order
+    _sizes:         list of decoded part sizes in file order
+    _blocks:        list per part of merkle leaf hashes fetched data is verified against, None if not verified
+    _offsets:       list of byte offsets at which each part starts
+    _size:          total decoded size of file
+    _key:           Fernet key if file is encrypted, otherwise None
+    _pos:           current read position
+    _lastEnd:       position at which the previous read ended, used to detect sequential reads
+    _readahead:     number of units to prefetch ahead of a sequential read
+    _cacheSize:     maximum number of units kept in _cache
+    _cache:         LRU of (part index, block index) to decoded bytes
+    _inflight:      map of unit to Event set when its fetch completes
+    _cacheMutex:    mutex for _cache and _inflight
+    _partHosts:     map of part hash to last peer it was found on
+    """
+
+    BLOCK_SIZE = merkle.BLOCK_SIZE
+    CACHE_UNITS = {False: 8, True: 2}
+    READAHEAD_UNITS = {False: 2, True: 1}
+
+    def __init__(self, node, parts, sizes, blocks=None, key=None, cacheSize=None, readahead=None):
+        """Creates a reader over a stored file.
+
+        Args:
+            node: StorageNode used to fetch data
+            parts: _parts
+            sizes: _sizes
+            blocks: _blocks, default is None
+            key: _key, default is None
+            cacheSize: _cacheSize, default is from CACHE_UNITS
+            readahead: _readahead, default is from READAHEAD_UNITS
+        """
+        super().__init__()
+        self._node = node
+        self._parts = list(parts)
+        self._sizes = list(sizes)
+        self._blocks = blocks
+        self._offsets = list()
+        offset = 0
+        for size in self._sizes:
+            self._offsets.append(offset)
+            offset += size
+        self._size = offset
+        self._key = key
+        self._pos = 0
+        self._lastEnd = 0
+        encrypted = key is not None
+        self._readahead = StoredFile.READAHEAD_UNITS[encrypted] if readahead is None else readahead
+        self._cacheSize = max(1, StoredFile.CACHE_UNITS[encrypted] if cacheSize is None else cacheSize)
+        self._cache = OrderedDict()
+        self._inflight = dict()
+        self._cacheMutex = Lock()
+        self._partHosts = dict()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Moves read position. Seeking past the end is allowed, reads there return no data."""
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == os.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('invalid whence %s' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %s' % pos)
+        self._pos = pos
+        return self._pos
+
+    def readinto(self, b):
+        """Reads up to len(b) bytes at the current position into b.
+
+        Returns:
+            number of bytes read, 0 at end of file
+        """
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        view = memoryview(b).cast('B')
+        sequential = self._pos == self._lastEnd
+        totalBytesRead = 0
+        unit = None
+        while totalBytesRead < len(view) and self._pos < self._size:
+            unit, unitStart = self._unitAt(self._pos)
+            data = self._getUnit(unit)
+            start = self._pos - unitStart
+            count = min(len(data) - start, len(view) - totalBytesRead)
+            view[totalBytesRead:totalBytesRead + count] = data[start:start + count]
+            totalBytesRead += count
+            self._pos += count
+        self._lastEnd = self._pos
+        if sequential and unit is not None:
+            self._prefetch(unit)
+        return totalBytesRead
+
+    def close(self):
+        """Closes file and drops cached data. In-flight prefetches finish but their data is discarded."""
+        super().close()
+        with self._cacheMutex:
+            self._cache.clear()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _unitAt(self, pos):
+        """Finds the cache unit containing a byte offset.
+
+        Returns:
+            tuple of unit (part index, block index) and the file offset at which the unit starts
+        """
+        partIndex = bisect.bisect_right(self._offsets, pos) - 1
+        if self._key:
+            # encrypted parts can only be decrypted whole
+            return (partIndex, 0), self._offsets[partIndex]
+        blockIndex = (pos - self._offsets[partIndex]) // StoredFile.BLOCK_SIZE
+        return (partIndex, blockIndex), self._offsets[partIndex] + blockIndex * StoredFile.BLOCK_SIZE
+
+    def _nextUnit(self, unit):
+        """Returns the unit following unit, or None if unit is the last one."""
+        partIndex, blockIndex = unit
+        if not self._key and (blockIndex + 1) * StoredFile.BLOCK_SIZE < self._sizes[partIndex]:
+            return (partIndex, blockIndex + 1)
+        if partIndex + 1 >= len(self._parts):
+            return None
+        return (partIndex + 1, 0)
+
+    def _getUnit(self, unit):
+        """Returns decoded bytes of a unit, fetching it if not cached. Waits on an in-flight prefetch of the same unit.
+
+        Raises:
+            IOError: if unit could not be found on any peer
+        """
+        while True:
+            with self._cacheMutex:
+                if unit in self._cache:
+                    self._cache.move_to_end(unit)
+                    return self._cache[unit]
+                event = self._inflight.get(unit)
+                if event is None:
+                    event = Event()
+                    self._inflight[unit] = event
+                    break
+            # another thread is fetching this unit, retry from cache once it is done (or fetch here if it failed)
+            event.wait()
+        try:
+            data = self._fetchUnit(unit)
+            with self._cacheMutex:
+                if not self.closed:
+                    self._cache[unit] = data
+                    while len(self._cache) > self._cacheSize:
+                        self._cache.popitem(last=False)
+            return data
+        finally:
+            with self._cacheMutex:
+                self._inflight.pop(unit, None)
+            event.set()
+
+    def _prefetch(self, unit):
+        """Starts fetching the _readahead units following unit in the background."""
+        for _ in range(self._readahead):
+            unit = self._nextUnit(unit)
+            if unit is None or self.closed:
+                return
+            with self._cacheMutex:
+                if unit in self._cache or unit in self._inflight:
+                    continue
+            Thread(target=self._prefetchUnit, args=(unit,), daemon=True).start()
+
+    def _prefetchUnit(self, unit):
+        if self.closed:
+            return
+        try:
+            self._getUnit(unit)
+        except Exception as e:
+            self._node._logger.info('prefetch of %s failed: %s' % (str(unit), e))
+
+    def _fetchUnit(self, unit):
+        """Fetches and decodes a unit from the first peer that has it.
+
+        Returns:
+            decoded bytes of unit
+
+        Raises:
+            IOError: if no peer returns the unit intact and in full
+        """
+        partIndex, blockIndex = unit
+        partHash = self._parts[partIndex]
+        lastHost = self._partHosts.get(partHash)
+        peers = list(self._node.peers)
+        if lastHost in peers:
+            peers.remove(lastHost)
+            peers.insert(0, lastHost)
+        if self._key:
+            length = self._sizes[partIndex]
+        else:
+            offset = blockIndex * StoredFile.BLOCK_SIZE
+            length = min(StoredFile.BLOCK_SIZE, self._sizes[partIndex] - offset)
+        for host, port in peers:
+            try:
+                if self._key:
+                    data = self._fetchPart(host, port, partIndex)
+                    if data is not None:
+                        data = Fernet(self._key).decrypt(data)
+                else:
+                    data = self._node.sendDataGetRange(host, port, partHash, offset, length)
+                    if data is not None and self._blocks and merkle.hashBlock(data) != self._blocks[partIndex][blockIndex]:
+                        self._node._logger.info('block %s of %s from %s:%s failed verification' % (blockIndex, partHash, host, port))
+                        continue
+            except OSError:
+                self._node._logger.info('failed to fetch %s from %s:%s' % (partHash, host, port))
+                continue
+            if data is None:
+                continue
+            if len(data) != length:
+                # e.g. truncated stored data, reading it would never reach the recorded size
+                self._node._logger.info('%s from %s:%s has %s bytes, expected %s' % (partHash, host, port, len(data), length))
+                continue
+            self._partHosts[partHash] = (host, port)
+            return data
+        raise IOError('unable to find part %s' % partHash)
+
+    def _fetchPart(self, host, port, partIndex):
+        """Fetches a whole part into memory, verifying its blocks if _blocks is known.
+
+        Returns:
+            part bytes, None if peer does not have it
+        """
+        fd, targetfile = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            blocks = self._blocks[partIndex] if self._blocks else None
+            if not self._node.sendDataGet(host, port, self._parts[partIndex], targetfile, blocks=blocks):
+                return None
+            with open(targetfile, 'rb') as f:
+                return f.read()
+        finally:
+            if os.path.isfile(targetfile):
+                os.remove(targetfile)
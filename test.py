@@ -3,6 +3,7 @@
 from storagenode import *
 from time import sleep
 import hashlib
+import random
 import os
 import socket
 
@@ -94,12 +95,131 @@ def main():
     recvfile = os.path.expandvars(os.path.join(a.dataDir, filename) + '.recv')
     a.uploadFile(testfile, encrypt=True)
     sleep(3)
-    a.downloadFile(os.path.basename(testfile), recvfile, decrypt=True)
+    assert(a.downloadFile(os.path.basename(testfile), recvfile, decrypt=True))
+    assert(a.verifyFile(os.path.basename(testfile)))
     assert(open(os.path.expandvars(testfile), 'rb').read() == open(os.path.expandvars(recvfile), 'rb').read())
     #os.remove(recvfile)
+    testdata = open(os.path.expandvars(testfile), 'rb').read()
+    with a.open(os.path.basename(testfile)) as stored:
+        offset = len(testdata) // 2
+        stored.seek(offset)
+        assert(stored.read(1048576) == testdata[offset:offset + 1048576])
+        stored.seek(0)
+        assert(stored.read() == testdata)
     sleep(3)
     a.removeFile(os.path.basename(testfile))
 
+    # unencrypted files are read by range, block by block
+    a.uploadFile(testfile)
+    sleep(3)
+    with a.open(os.path.basename(testfile)) as stored:
+        assert(stored.size == len(testdata))
+        # read across a part boundary
+        offset = StorageNode.PART_SIZE - 1000
+        stored.seek(offset)
+        assert(stored.read(1048576) == testdata[offset:offset + 1048576])
+        stored.seek(-100, os.SEEK_END)
+        assert(stored.read() == testdata[-100:])
+        assert(stored.read(10) == b'')
+        randomSeek = random.Random(0)
+        for _ in range(20):
+            offset = randomSeek.randrange(len(testdata))
+            length = randomSeek.randrange(3 * 1048576)
+            stored.seek(offset)
+            assert(stored.read(length) == testdata[offset:offset + length])
+        # sequential reads of sizes not aligned to blocks, prefetching ahead
+        stored.seek(0)
+        chunks = list()
+        while True:
+            chunk = stored.read(1048576 + 7)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        assert(b''.join(chunks) == testdata)
+    sleep(3)
+    a.removeFile(os.path.basename(testfile))
+
+    print('---------------------------------------------------')
+    # interrupted upload continues from the first unconfirmed part
+    basename = os.path.basename(testfile)
+    sendDataAdd = a.sendDataAdd
+    sent = list()
+    def interruptedDataAdd(*args, **kwargs):
+        sent.append(args)
+        if len(sent) == 2:
+            raise ConnectionResetError('interrupted')
+        return sendDataAdd(*args, **kwargs)
+    a.sendDataAdd = interruptedDataAdd
+    try:
+        a.uploadFile(testfile)
+        assert(False)
+    except ConnectionResetError:
+        pass
+    assert(basename not in eval(open(a.filePartsLoader).read()))
+    a.uploadFile(testfile)
+    del a.sendDataAdd
+    parts = eval(open(a.filePartsLoader).read())[basename]['parts']
+    assert(len(sent) == len(parts) + 1)
+    # download with a part missing and an unreachable peer keeps verified parts, then resumes with the rest
+    nodes = {node.thisPeer: node for node in (a, b, c, d, e)}
+    deadPeer = list(a.peers)[0]
+    hiddenPart = parts[-1]
+    holder = [node for node in nodes.values() if os.path.isfile(os.path.expandvars(os.path.join(node.dataDir, hiddenPart)))][0]
+    hiddenFile = os.path.expandvars(os.path.join(holder.dataDir, hiddenPart))
+    os.rename(hiddenFile, hiddenFile + '.hidden')
+    sendDataGet = a.sendDataGet
+    def unreachableDataGet(host, port, *args, **kwargs):
+        if (host, port) == deadPeer:
+            raise ConnectionRefusedError('unreachable')
+        return sendDataGet(host, port, *args, **kwargs)
+    a.sendDataGet = unreachableDataGet
+    assert(not a.downloadFile(basename, recvfile))
+    os.rename(hiddenFile + '.hidden', hiddenFile)
+    requested = set()
+    def recordingDataGet(host, port, datahash, *args, **kwargs):
+        requested.add(datahash)
+        return sendDataGet(host, port, datahash, *args, **kwargs)
+    a.sendDataGet = recordingDataGet
+    assert(a.downloadFile(basename, recvfile))
+    del a.sendDataGet
+    deadParts = set(part for part in parts if os.path.isfile(os.path.expandvars(os.path.join(nodes[deadPeer].dataDir, part))))
+    assert(requested == deadParts | {hiddenPart})
+    assert(open(os.path.expandvars(testfile), 'rb').read() == open(recvfile, 'rb').read())
+    # a corrupt replica fails verification and is not repaired by it
+    assert(a.verifyFile(basename))
+    partData = open(hiddenFile, 'rb').read()
+    open(hiddenFile, 'r+b').write(b'corrupt')
+    assert(not a.verifyFile(basename))
+    assert(open(hiddenFile, 'rb').read()[:7] == b'corrupt')
+    open(hiddenFile, 'wb').write(partData)
+    assert(a.verifyFile(basename))
+    os.remove(recvfile)
+    sleep(3)
+    a.removeFile(basename)
+
+    print('---------------------------------------------------')
+    # only new and changed files are uploaded by a sync, files that vanish while syncing are skipped
+    syncdir = os.path.expandvars(os.path.join(storagedir, 'sync'))
+    syncfiles = {'a.bin': 100, os.path.join('b', 'b.bin'): 200000, os.path.join('b', 'c', 'c.bin'): 3}
+    for name, size in syncfiles.items():
+        os.makedirs(os.path.dirname(os.path.join(syncdir, name)), exist_ok=True)
+        open(os.path.join(syncdir, name), 'wb').write(os.urandom(size))
+    walkDirectory = a._walkDirectory
+    a._walkDirectory = lambda path, workers: walkDirectory(path, workers) + [(os.path.join(path, 'vanished.bin'), os.stat(path))]
+    assert(sorted(a.syncDirectory(syncdir)) == sorted(syncfiles))
+    del a._walkDirectory
+    assert(a.syncDirectory(syncdir) == [])
+    open(os.path.join(syncdir, 'b', 'b.bin'), 'ab').write(b'changed')
+    assert(a.syncDirectory(syncdir) == [os.path.join('b', 'b.bin')])
+    assert(a.syncDirectory(syncdir) == [])
+    assert(sorted(a.syncDirectory(syncdir, encrypt=True)) == sorted(syncfiles))
+    assert(a.syncDirectory(syncdir, encrypt=True) == [])
+    assert(a.downloadFile(os.path.join('b', 'b.bin'), recvfile, decrypt=True))
+    assert(open(os.path.join(syncdir, 'b', 'b.bin'), 'rb').read() == open(recvfile, 'rb').read())
+    os.remove(recvfile)
+    for name in syncfiles:
+        a.removeFile(name)
+
     a.shutdown()
     b.shutdown()
     c.shutdown()
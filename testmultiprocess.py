@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+from storagenode import *
+from multiprocessnode import MultiProcessStorageNode
+from time import sleep
+import hashlib
+import logging
+import os
+import socket
+import time
+
+def main():
+    storagedir = '$PWD/data/'
+    host = socket.gethostbyname(socket.gethostname())
+    # change baseport if test start fails, likely due to previous test socket not completely shutdown by system
+    baseport = 8100
+    m = MultiProcessStorageNode(os.path.join(storagedir, str(baseport)), host=host, port=baseport, workers=2, logLevel=logging.INFO)
+    a = StorageNode(os.path.join(storagedir, str(baseport+1)), host=host, port=baseport+1)
+    b = StorageNode(os.path.join(storagedir, str(baseport+2)), host=host, port=baseport+2)
+
+    # membership requests accepted by workers are handled by the parent
+    a.joinNetwork(host, baseport)
+    sleep(1)
+    assert(a.peers == {m.thisPeer})
+    assert(m.peers == {a.thisPeer})
+    b.joinNetwork(host, baseport)
+    sleep(1)
+    assert(b.peers == {a.thisPeer, m.thisPeer})
+    assert(m.peers == {a.thisPeer, b.thisPeer})
+    b.leaveNetwork()
+    sleep(1)
+    assert(m.peers == {a.thisPeer})
+
+    # data requests are served by workers from the shared data directory
+    data = os.urandom(3 * 1048576)
+    datahash = hashlib.sha256(data).hexdigest()
+    recvfile = os.path.expandvars(os.path.join(a.dataDir, datahash) + '.recv')
+    for _ in range(4):
+        assert(a.sendDataAdd(host, baseport, bytedata=data) == datahash)
+    assert(os.path.isfile(os.path.expandvars(os.path.join(m.dataDir, datahash))))
+    assert(not [f for f in os.listdir(os.path.expandvars(m.dataDir)) if f.endswith('.tmp')])
+    for _ in range(4):
+        assert(a.sendDataGet(host, baseport, datahash, recvfile) == recvfile)
+        assert(open(recvfile, 'rb').read() == data)
+        assert(a.sendDataGetRange(host, baseport, datahash, 5, 100) == data[5:105])
+
+    # rates set on the node's scheduler are split between workers and apply to the requests they serve
+    m.scheduler.setGlobalRate(2 * 1048576)
+    sleep(1)
+    for _ in range(2):
+        start = time.monotonic()
+        assert(a.sendDataGet(host, baseport, datahash, recvfile) == recvfile)
+        assert(time.monotonic() - start > 1.5)
+
+    # exited workers are restarted, also after a failed restart
+    workers = m.workers
+    startWorker = m._startWorker
+    restarts = list()
+    def failingStartWorker():
+        restarts.append(None)
+        if len(restarts) == 1:
+            raise Exception('worker failed to start')
+        return startWorker()
+    m._startWorker = failingStartWorker
+    workers[0].kill()
+    sleep(5)
+    del m._startWorker
+    assert(len(restarts) == 2)
+    assert(m.workers[0] is not workers[0] and m.workers[1] is workers[1])
+    assert(all(worker.is_alive() for worker in m.workers))
+    for _ in range(4):
+        assert(a.sendDataGetRange(host, baseport, datahash, 0, 10) == data[:10])
+    # a restarted worker is started with the current rates
+    for _ in range(2):
+        start = time.monotonic()
+        assert(a.sendDataGet(host, baseport, datahash, recvfile) == recvfile)
+        assert(time.monotonic() - start > 1.5)
+    m.scheduler.setGlobalRate(None)
+    sleep(1)
+    for _ in range(2):
+        start = time.monotonic()
+        assert(a.sendDataGet(host, baseport, datahash, recvfile) == recvfile)
+        assert(time.monotonic() - start < 1)
+    os.remove(recvfile)
+    a.sendDataRemove(host, baseport, datahash)
+    sleep(1)
+    assert(not os.path.isfile(os.path.expandvars(os.path.join(m.dataDir, datahash))))
+
+    workers = m.workers
+    a.shutdown()
+    b.shutdown()
+    m.shutdown()
+    assert(not any(worker.is_alive() for worker in workers))
+
+    print('Tests passed')
+
+if __name__ == '__main__':
+    # workers are spawned, they import this module without running main()
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+from scheduler import *
+import scheduler as schedulerModule
+from threading import Thread
+from time import monotonic, sleep
+
+def main():
+    chunk = TransferScheduler.QUANTUM
+    granted = list()
+    def transfer(scheduler, name, priority, flow, chunks, host='127.0.0.1'):
+        for _ in range(chunks):
+            scheduler.acquire(host, chunk, priority, flow)
+            granted.append(name)
+
+    # interactive chunks queued behind uploads are granted before the remaining uploads
+    scheduler = TransferScheduler(globalRate=16 * chunk)
+    # overdraw the bucket so uploads are rate limited from the start rather than sent in a burst
+    scheduler.acquire('127.0.0.1', 32 * chunk)
+    writes = [Thread(target=transfer, args=(scheduler, name, Priority.WRITE, name, 16)) for name in ('write1', 'write2')]
+    for thread in writes:
+        thread.start()
+    sleep(0.3)
+    interactive = Thread(target=transfer, args=(scheduler, 'read', Priority.INTERACTIVE, 'read', 4))
+    interactive.start()
+    for thread in writes + [interactive]:
+        thread.join()
+    first = granted.index('read')
+    assert(granted[first:first + 4] == ['read'] * 4)
+    assert(len(granted) - first - 4 > 16)
+
+    # flows of the same priority take turns
+    granted.clear()
+    scheduler = TransferScheduler(globalRate=16 * chunk)
+    # overdraw the bucket so both flows are queued before the first chunk is granted
+    scheduler.acquire('127.0.0.1', 32 * chunk)
+    writes = [Thread(target=transfer, args=(scheduler, name, Priority.WRITE, name, 8)) for name in ('write1', 'write2')]
+    for thread in writes:
+        thread.start()
+    for thread in writes:
+        thread.join()
+    assert(all(granted[i] != granted[i + 1] for i in range(len(granted) - 1)))
+
+    # a peer rate holds transfers to it to that rate after the initial burst, other peers are unaffected
+    scheduler = TransferScheduler()
+    start = monotonic()
+    transfer(scheduler, 'unlimited', Priority.WRITE, None, 1000)
+    assert(monotonic() - start < 1)
+    scheduler.setPeerRate('127.0.0.2', 10 * chunk)
+    start = monotonic()
+    transfer(scheduler, 'limited', Priority.WRITE, None, 20, host='127.0.0.2')
+    assert(0.9 < monotonic() - start < 1.5)
+    start = monotonic()
+    transfer(scheduler, 'unlimited', Priority.WRITE, None, 1000)
+    assert(monotonic() - start < 1)
+
+    # a global rate change applies to a waiting transfer
+    scheduler = TransferScheduler(globalRate=chunk)
+    scheduler.acquire('127.0.0.1', 100 * chunk)
+    waiting = Thread(target=transfer, args=(scheduler, 'waiting', Priority.WRITE, None, 1))
+    start = monotonic()
+    waiting.start()
+    sleep(0.2)
+    scheduler.setGlobalRate(None)
+    waiting.join()
+    assert(monotonic() - start < 1)
+
+    # a chunk waiting behind another thread's chunk is granted once its peer refills, without other traffic
+    class ScriptedClock:
+        """Returns each scripted time once, then time."""
+        def __init__(self):
+            self.time = 0
+            self.script = list()
+        def __call__(self):
+            return self.script.pop(0) if self.script else self.time
+    clock = ScriptedClock()
+    schedulerModule.monotonic = clock
+    try:
+        scheduler = TransferScheduler()
+        scheduler.setPeerRate('127.0.0.3', chunk)
+        scheduler.setPeerRate('127.0.0.4', chunk)
+        # 127.0.0.3 refills at time 1, 127.0.0.4 at time 0.5
+        scheduler.acquire('127.0.0.3', 2 * chunk)
+        scheduler.acquire('127.0.0.4', chunk + chunk // 2)
+        write = Thread(target=transfer, args=(scheduler, 'write', Priority.WRITE, None, 1, '127.0.0.4'), daemon=True)
+        write.start()
+        sleep(0.1)
+        # the read sees only the write grantable, the woken write then sees only the read grantable
+        clock.script = [0.6]
+        clock.time = 1.1
+        read = Thread(target=transfer, args=(scheduler, 'read', Priority.INTERACTIVE, None, 1, '127.0.0.3'), daemon=True)
+        read.start()
+        read.join(3)
+        write.join(3)
+        assert(not read.is_alive() and not write.is_alive())
+    finally:
+        schedulerModule.monotonic = monotonic
+
+    print('Tests passed')
+
+main()